@@ -1,14 +1,22 @@
-import os, time, hashlib
-from collections import defaultdict, deque
-from datetime import datetime, timedelta
-from typing import List, Optional
+import os, re, time, gzip, hashlib, asyncio, logging
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple, TypeVar
 
-from fastapi import FastAPI, HTTPException, Request, Depends
+from fastapi import FastAPI, HTTPException, Request, Response, Depends, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from openai import OpenAI
-from psycopg_pool import AsyncConnectionPool
+from cachetools import LRUCache, TTLCache
+import httpx
+import openai
+from openai import AsyncOpenAI
+import asyncpg
+import orjson
+import tiktoken
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 MAX_REQ_PER_MIN = int(os.getenv("MAX_REQ_PER_MIN", "60"))
@@ -16,11 +24,30 @@ WINDOW_SEC = 60
 EXT_IDS = [s.strip() for s in os.getenv("EXT_IDS", "").split(",") if s.strip()]
 ALLOWED_ORIGINS = [f"chrome-extension://{eid}" for eid in EXT_IDS] or ["*"]
 DATABASE_URL = os.getenv("DATABASE_URL")
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_TIMEOUT_S = float(os.getenv("REDIS_TIMEOUT_S", "0.3"))
+DB_TIMEOUT_S = float(os.getenv("DB_TIMEOUT_S", "10"))
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "changeme")
 IP_SALT = os.getenv("IP_SALT", "pepper")
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "5"))
+CACHE_TTL_S = int(os.getenv("CACHE_TTL_S", "3600"))
+CACHE_MAX = int(os.getenv("CACHE_MAX", "10000"))
+MAX_TOKENS_PER_CHUNK = int(os.getenv("MAX_TOKENS_PER_CHUNK", "1500"))
+CHARS_PER_TOKEN = 4
+REQUEST_TIMEOUT_S = float(os.getenv("REQUEST_TIMEOUT_S", "45"))
 
-client = OpenAI()
-app = FastAPI(title="Summarize API")
+log = logging.getLogger("summarize")
+OPENAI_SEM = asyncio.Semaphore(OPENAI_CONCURRENCY)
+client = AsyncOpenAI(
+    timeout=REQUEST_TIMEOUT_S,
+    max_retries=2,
+    http_client=httpx.AsyncClient(
+        http2=True,
+        timeout=REQUEST_TIMEOUT_S,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    ),
+)
+app = FastAPI(title="Summarize API", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -29,12 +56,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class NoStreamGZipMiddleware(GZipMiddleware):
+    # GZipMiddleware buffers its compressor output, which stalls server-sent events.
+    STREAM_PATHS = {"/summarize/stream"}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.STREAM_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(NoStreamGZipMiddleware, minimum_size=512)
+
 @app.get("/health")
 def health():
     return {"ok": True}
 
-POOL: AsyncConnectionPool | None = None
+POOL: asyncpg.Pool | None = None
 
+DDL_LOCK_ID = 0x53534149  # arbitrary constant shared by all workers
 DDL = """
 CREATE TABLE IF NOT EXISTS pings(
   id BIGSERIAL PRIMARY KEY,
@@ -48,35 +88,221 @@ CREATE TABLE IF NOT EXISTS pings(
 CREATE INDEX IF NOT EXISTS idx_pings_ts ON pings(ts);
 CREATE INDEX IF NOT EXISTS idx_pings_user_ts ON pings(user_id, ts);
 CREATE INDEX IF NOT EXISTS idx_pings_action_ts ON pings(action, ts);
+CREATE INDEX IF NOT EXISTS idx_pings_summary_ts ON pings(ts) WHERE action='successful_summary';
+CREATE INDEX IF NOT EXISTS idx_pings_error_ts ON pings(ts) WHERE action='error';
+CREATE TABLE IF NOT EXISTS ping_users(
+  user_id TEXT PRIMARY KEY,
+  first_seen TIMESTAMPTZ NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_ping_users_first_seen ON ping_users(first_seen);
+INSERT INTO ping_users(user_id, first_seen)
+  SELECT user_id, MIN(ts) FROM pings
+  WHERE NOT EXISTS (SELECT 1 FROM ping_users)
+  GROUP BY user_id;
+CREATE TABLE IF NOT EXISTS ping_user_count(
+  id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+  n BIGINT NOT NULL
+);
+INSERT INTO ping_user_count(n) SELECT COUNT(*) FROM ping_users ON CONFLICT DO NOTHING;
 """
 
 @app.on_event("startup")
 async def init_db():
-    global POOL
+    global POOL, _ping_task, _push_task
     if not DATABASE_URL:
         return
-    POOL = AsyncConnectionPool(conninfo=DATABASE_URL, min_size=1, max_size=5)
-    async with POOL.connection() as conn:
+    POOL = await asyncpg.create_pool(dsn=DATABASE_URL, min_size=10, max_size=50, max_inactive_connection_lifetime=300, command_timeout=DB_TIMEOUT_S)
+    async with POOL.acquire() as conn:
         async with conn.transaction():
+            # Serialize schema setup across workers; concurrent IF NOT EXISTS can still collide.
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", DDL_LOCK_ID)
             await conn.execute(DDL)
+    _ping_task = asyncio.create_task(ping_flusher())
+    _push_task = asyncio.create_task(analytics_pusher())
 
-async def get_pool() -> AsyncConnectionPool:
+@app.on_event("shutdown")
+async def close_db():
+    if _push_task is not None:
+        _push_task.cancel()
+        await asyncio.gather(_push_task, return_exceptions=True)
+    if _ping_task is not None:
+        # The sentinel queues behind every pending ping, so the flusher writes them all
+        # (including the batch it is holding) before it returns. A hung database must
+        # not hang shutdown, so the wait is bounded.
+        try:
+            _ping_queue.put_nowait(None)
+        except asyncio.QueueFull:
+            _ping_task.cancel()
+        await asyncio.wait({_ping_task}, timeout=DB_TIMEOUT_S)
+        _ping_task.cancel()
+        await asyncio.gather(_ping_task, return_exceptions=True)
+        batch = []
+        while not _ping_queue.empty():
+            row = _ping_queue.get_nowait()
+            if row is not None:
+                batch.append(row)
+        if batch:
+            try:
+                await asyncio.wait_for(flush_pings(batch), DB_TIMEOUT_S)
+            except Exception:
+                log.exception("Dropped %d pings on shutdown", len(batch))
+    if POOL is not None:
+        await POOL.close()
+
+@app.on_event("shutdown")
+async def close_openai():
+    await client.close()
+
+async def get_pool() -> asyncpg.Pool:
     if POOL is None:
         raise HTTPException(500, "Database not initialized")
     return POOL
 
-_buckets: defaultdict[str, deque] = defaultdict(deque)
+PING_COLUMNS = ["user_id", "action", "ext_version", "ua", "ip_hash"]
+PING_SQL = """
+WITH rows AS (
+  INSERT INTO pings(user_id,action,ext_version,ua,ip_hash)
+  SELECT * FROM unnest($1::text[], $2::text[], $3::text[], $4::text[], $5::text[])
+  RETURNING user_id
+), new_users AS (
+  INSERT INTO ping_users(user_id, first_seen) SELECT DISTINCT user_id, NOW() FROM rows ON CONFLICT DO NOTHING
+  RETURNING 1
+)
+UPDATE ping_user_count SET n = n + (SELECT COUNT(*) FROM new_users) WHERE EXISTS (SELECT 1 FROM new_users)
+"""
+PING_BATCH_MAX = int(os.getenv("PING_BATCH_MAX", "500"))
+PING_FLUSH_S = int(os.getenv("PING_FLUSH_MS", "100")) / 1000
+PING_COPY_MIN = 100
+USERS_SQL = """
+WITH new_users AS (
+  INSERT INTO ping_users(user_id, first_seen) SELECT u, NOW() FROM unnest($1::text[]) u ON CONFLICT DO NOTHING
+  RETURNING 1
+)
+UPDATE ping_user_count SET n = n + (SELECT COUNT(*) FROM new_users) WHERE EXISTS (SELECT 1 FROM new_users)
+"""
+# Bounded so a stalled database drops pings instead of growing memory without limit.
+_ping_queue: asyncio.Queue = asyncio.Queue(maxsize=PING_BATCH_MAX * 20)
+_ping_drop_at = float("-inf")
+_ping_task: asyncio.Task | None = None
+
+async def flush_pings(batch: list) -> None:
+    async with POOL.acquire(timeout=DB_TIMEOUT_S) as conn:
+        if len(batch) < PING_COPY_MIN:
+            # One prepared statement and one round trip covers both tables.
+            await conn.execute(PING_SQL, *(list(col) for col in zip(*batch)))
+            return
+        async with conn.transaction():
+            await conn.copy_records_to_table("pings", records=batch, columns=PING_COLUMNS)
+            await conn.execute(USERS_SQL, list({row[0] for row in batch}))
+
+async def ping_flusher():
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        row = await _ping_queue.get()
+        if row is None:
+            return
+        batch = [row]
+        deadline = loop.time() + PING_FLUSH_S
+        while len(batch) < PING_BATCH_MAX:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(_ping_queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                stopping = True
+                break
+            batch.append(row)
+        try:
+            await flush_pings(batch)
+        except asyncio.CancelledError:
+            log.warning("Dropped %d pings on cancel", len(batch))
+            raise
+        except Exception:
+            log.exception("Dropped %d pings", len(batch))
+        else:
+            _pings_changed.set()
+
+REFILL_PER_SEC = MAX_REQ_PER_MIN / WINDOW_SEC
+_buckets: LRUCache = LRUCache(maxsize=100_000)
 
-def allow_ip(ip: str) -> bool:
-    now = time.time()
-    q = _buckets[ip]
-    while q and now - q[0] > WINDOW_SEC:
-        q.popleft()
-    if len(q) >= MAX_REQ_PER_MIN:
+def allow_ip_local(ip: str) -> bool:
+    now = time.monotonic()
+    tokens, last = _buckets.get(ip, (MAX_REQ_PER_MIN, now))
+    tokens = min(MAX_REQ_PER_MIN, tokens + (now - last) * REFILL_PER_SEC)
+    if tokens < 1:
+        _buckets[ip] = (tokens, now)
         return False
-    q.append(now)
+    _buckets[ip] = (tokens - 1, now)
     return True
 
+_reaper_task: asyncio.Task | None = None
+
+async def bucket_reaper():
+    # A bucket idle for a full window is back at capacity, so dropping it changes nothing.
+    while True:
+        await asyncio.sleep(60)
+        try:
+            cutoff = time.monotonic() - 2 * WINDOW_SEC
+            for ip in [ip for ip, (_, last) in list(_buckets.items()) if last < cutoff]:
+                _buckets.pop(ip, None)
+        except Exception:
+            log.exception("Rate-limit reaper pass failed")
+
+RATE_LUA = """
+local c = redis.call('INCR', KEYS[1])
+if c == 1 then redis.call('EXPIRE', KEYS[1], ARGV[1]) end
+return c
+"""
+REDIS: aioredis.Redis | None = None
+_rate_script = None
+_redis_err_at = float("-inf")
+
+@app.on_event("startup")
+async def init_redis():
+    global REDIS, _rate_script
+    if not REDIS_URL:
+        return
+    # Short timeouts: a stalled Redis must fall back to the local bucket, not hang requests.
+    REDIS = aioredis.from_url(
+        REDIS_URL, socket_connect_timeout=REDIS_TIMEOUT_S, socket_timeout=REDIS_TIMEOUT_S
+    )
+    # register_script runs via EVALSHA and reloads the script on NOSCRIPT.
+    _rate_script = REDIS.register_script(RATE_LUA)
+
+@app.on_event("shutdown")
+async def close_redis():
+    if REDIS is not None:
+        await REDIS.aclose()
+
+async def allow_ip(ip: str) -> bool:
+    global _redis_err_at
+    # After a failure, skip Redis for a window so an outage doesn't add its timeout to
+    # every request; the first call after the cool-down probes it again.
+    if _rate_script is None or time.monotonic() - _redis_err_at < WINDOW_SEC:
+        return allow_ip_local(ip)
+    key = f"rl:{ip}:{int(time.time() // WINDOW_SEC)}"
+    try:
+        count = await _rate_script(keys=[key], args=[WINDOW_SEC])
+    except RedisError as e:
+        _redis_err_at = time.monotonic()
+        log.warning("Redis rate limit check failed (%r); using local bucket for %ds", e, WINDOW_SEC)
+        return allow_ip_local(ip)
+    return count <= MAX_REQ_PER_MIN
+
+@app.on_event("startup")
+async def start_reaper():
+    global _reaper_task
+    _reaper_task = asyncio.create_task(bucket_reaper())
+
+@app.on_event("shutdown")
+async def stop_reaper():
+    if _reaper_task is not None:
+        _reaper_task.cancel()
+
 class SummarizeRequest(BaseModel):
     text: str = Field(min_length=1)
     tone: str = Field(default="precise", pattern=r"^[a-zA-Z\- ]{1,32}$")
@@ -90,55 +316,280 @@ class Ping(BaseModel):
     action: str = "summary"
     ext_version: Optional[str] = None
 
-def chunk(t: str, max_chars: int = 6000) -> List[str]:
-    t = t.strip()
-    if len(t) <= max_chars:
-        return [t]
-    parts: List[str] = []
-    i = 0
-    while i < len(t):
-        end = min(len(t), i + max_chars)
-        cut = max(t.rfind("\n\n", i, end), t.rfind(". ", i, end))
-        if cut == -1 or cut <= i + int(max_chars * 0.4):
-            cut = end
-        parts.append(t[i:cut].strip())
-        i = cut
-    return [p for p in parts if p]
-
-def summarize_chunk(txt: str, tone: str, n: int) -> str:
-    prompt = f"Summarize the following text in at most {n} sentences. Tone: {tone}. Focus on key facts. Avoid fluff.\n\nTEXT:\n{txt}"
-    r = client.chat.completions.create(model=MODEL, messages=[{"role": "user", "content": prompt}], temperature=0.2)
+PARA_SEP = re.compile(r"(\n(?:[ \t]*\n)+)")
+
+def dedupe_paragraphs(t: str) -> str:
+    # Drop repeated blank-line-separated blocks (nav, footers, cookie banners); repeated
+    # lines inside a block (song choruses, table rows) are content and stay.
+    parts = PARA_SEP.split(t)
+    seen: set = set()
+    kept: List[str] = [parts[0]]
+    seen.add(parts[0].strip())
+    for i in range(1, len(parts), 2):
+        sep, block = parts[i], parts[i + 1]
+        key = block.strip()
+        if key and key in seen:
+            continue
+        seen.add(key)
+        kept.append(sep)
+        kept.append(block)
+    return "".join(kept)
+
+BREAKS = re.compile(r"\n\n|\. (?=[A-Z])")
+
+_enc: Optional[tiktoken.Encoding] = None
+_enc_failed = False
+
+def encoder() -> Optional[tiktoken.Encoding]:
+    # The BPE file is downloaded on first load; if that fails, chunk by characters instead.
+    global _enc, _enc_failed
+    if _enc is None and not _enc_failed:
+        try:
+            try:
+                _enc = tiktoken.encoding_for_model(MODEL)
+            except KeyError:
+                _enc = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _enc_failed = True
+            log.exception("tiktoken encoding unavailable; using %d chars per token", CHARS_PER_TOKEN)
+    return _enc
+
+_enc_task: asyncio.Task | None = None
+
+@app.on_event("startup")
+async def load_encoder():
+    # The download has no timeout, so warm up in the background and never block startup on it.
+    global _enc_task
+    _enc_task = asyncio.create_task(asyncio.to_thread(encoder))
+
+def token_offsets(t: str) -> List[int]:
+    # Until the background load finishes, requests use the character budget.
+    enc = _enc
+    if enc is None:
+        return list(range(0, len(t), CHARS_PER_TOKEN))
+    _, offsets = enc.decode_with_offsets(enc.encode(t, disallowed_special=()))
+    return offsets
+
+def trim_span(t: str, s: int, e: int) -> Tuple[int, int]:
+    while s < e and t[s].isspace():
+        s += 1
+    while e > s and t[e - 1].isspace():
+        e -= 1
+    return s, e
+
+def _chunk_spans(t: str, max_tokens: int) -> List[Tuple[int, int]]:
+    # Every token covers at least one UTF-8 byte, so short text needs no encoding.
+    if len(t.encode()) <= max_tokens:
+        return [(0, len(t))]
+    offsets = token_offsets(t)
+    if len(offsets) <= max_tokens:
+        return [(0, len(t))]
+    breaks = [m.end() for m in BREAKS.finditer(t)]
+    spans: List[Tuple[int, int]] = []
+    start, tok = 0, 0
+    while len(offsets) - tok > max_tokens:
+        end = offsets[tok + max_tokens]
+        j = bisect_right(breaks, end) - 1
+        cut = breaks[j] if j >= 0 and breaks[j] > offsets[tok + int(max_tokens * 0.4)] else end
+        if cut <= start:
+            # A single character can span more than max_tokens byte-level tokens; take it whole.
+            k = bisect_right(offsets, start, tok)
+            cut = offsets[k] if k < len(offsets) else len(t)
+        spans.append(trim_span(t, start, cut))
+        start = cut
+        tok = bisect_left(offsets, cut, tok)
+    spans.append(trim_span(t, start, len(t)))
+    return [(s, e) for s, e in spans if s < e]
+
+def chunk(t: str, max_tokens: int = MAX_TOKENS_PER_CHUNK) -> List[str]:
+    t = dedupe_paragraphs(t).strip()
+    # Spans are trimmed by index so each chunk is materialized with a single slice.
+    return [t[s:e] for s, e in _chunk_spans(t, max_tokens)]
+
+@lru_cache(maxsize=64)
+def tone_instruction(tone: str, n: int) -> str:
+    return f"Summarize the following text in at most {n} sentences. Tone: {tone}. Focus on key facts. Avoid fluff.\n\nTEXT:\n"
+
+@lru_cache(maxsize=16)
+def combine_instruction(n: int) -> str:
+    return f"Combine to at most {n} sentences:\n\n"
+
+async def summarize_chunk(txt: str, tone: str, n: int) -> str:
+    prompt = tone_instruction(tone, n) + txt
+    async with OPENAI_SEM:
+        r = await client.chat.completions.create(model=MODEL, messages=[{"role": "user", "content": prompt}], temperature=0.2)
     return (r.choices[0].message.content or "").strip()
 
+async def stream_chunk(txt: str, tone: str, n: int) -> AsyncIterator[str]:
+    prompt = tone_instruction(tone, n) + txt
+    async with OPENAI_SEM:
+        stream = await client.chat.completions.create(model=MODEL, messages=[{"role": "user", "content": prompt}], temperature=0.2, stream=True)
+        async for ev in stream:
+            if ev.choices and ev.choices[0].delta.content:
+                yield ev.choices[0].delta.content
+
+_cache: TTLCache = TTLCache(maxsize=CACHE_MAX, ttl=CACHE_TTL_S)
+
+def cache_key(tone: str, n: int, txt: str) -> str:
+    return hashlib.blake2b(f"{tone}|{n}|{txt}".encode(), digest_size=16).hexdigest()
+
+def chunk_key(tone: str, n: int, ch: str) -> str:
+    return "c:" + cache_key(tone, n, ch)
+
+async def summarize_parts(pieces: List[str], tone: str, n: int) -> List[str]:
+    keys = [chunk_key(tone, n, p) for p in pieces]
+    partials: List[Optional[str]] = [_cache.get(k) for k in keys]
+    missing = [i for i, p in enumerate(partials) if p is None]
+    async def one(i: int) -> None:
+        out = await summarize_chunk(pieces[i], tone, n)
+        partials[i] = out
+        if out:
+            _cache[keys[i]] = out
+    await asyncio.gather(*(one(i) for i in missing))
+    return partials
+
+async def final_input(pieces: List[str], tone: str, n: int) -> str:
+    if len(pieces) == 1:
+        return pieces[0]
+    partials = await summarize_parts(pieces, tone, n)
+    return combine_instruction(n) + "\n\n".join(partials)
+
+def upstream_error(e: openai.OpenAIError) -> HTTPException:
+    if isinstance(e, openai.RateLimitError):
+        if getattr(e, "code", None) == "insufficient_quota":
+            return HTTPException(402, "OpenAI quota exhausted")
+        return HTTPException(429, "Upstream rate limited")
+    if isinstance(e, openai.APITimeoutError):
+        return HTTPException(504, "Upstream timed out")
+    if isinstance(e, openai.AuthenticationError):
+        return HTTPException(500, "OpenAI authentication failed")
+    return HTTPException(502, f"Upstream error: {e}")
+
+T = TypeVar("T")
+_inflight: dict[str, asyncio.Future] = {}
+
+async def single_flight(key: str, fn: Callable[[], Awaitable[T]]) -> T:
+    # Concurrent callers with the same key share the first caller's result.
+    while (fut := _inflight.get(key)) is not None:
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            if not fut.cancelled():
+                raise  # this caller was cancelled, not the leader
+            # The leader's client went away; retry, taking over as leader if nobody has.
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    try:
+        out = await fn()
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except BaseException as e:
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved so an unshared failure isn't logged twice
+        raise
+    else:
+        fut.set_result(out)
+        return out
+    finally:
+        del _inflight[key]
+
 @app.post("/summarize", response_model=SummarizeResponse)
-async def summarize(req: SummarizeRequest, request: Request):
+async def summarize(req: SummarizeRequest, request: Request, response: Response):
     ip = request.client.host if request.client else "unknown"
-    if not allow_ip(ip):
+    if not await allow_ip(ip):
         raise HTTPException(429, "Too many requests")
     text = req.text.strip()
     if not text:
         raise HTTPException(400, "Empty text")
+    key = cache_key(req.tone, req.maxSentences, text)
+    cached = _cache.get(key)
+    response.headers["X-Cache"] = "HIT" if cached else "MISS"
+    if cached:
+        return {"summary": cached}
+    async def run() -> str:
+        final = await final_input(chunk(text), req.tone, req.maxSentences)
+        out = await summarize_chunk(final, req.tone, req.maxSentences)
+        if out:
+            _cache[key] = out
+        return out
     try:
-        pieces = chunk(text)
-        if len(pieces) == 1:
-            out = summarize_chunk(pieces[0], req.tone, req.maxSentences)
-        else:
-            partials = [summarize_chunk(p, req.tone, req.maxSentences) for p in pieces]
-            stitched = "\n\n".join(partials)
-            out = summarize_chunk(f"Combine to at most {req.maxSentences} sentences:\n\n{stitched}", req.tone, req.maxSentences)
+        out = await single_flight(key, run)
         return {"summary": out or "(no summary produced)"}
+    except openai.OpenAIError as e:
+        raise upstream_error(e)
     except Exception as e:
         raise HTTPException(500, f"Summarization failed: {e}")
 
+def sse(data: dict) -> bytes:
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+@app.post("/summarize/stream")
+async def summarize_stream(req: SummarizeRequest, request: Request):
+    ip = request.client.host if request.client else "unknown"
+    if not await allow_ip(ip):
+        raise HTTPException(429, "Too many requests")
+    text = req.text.strip()
+    if not text:
+        raise HTTPException(400, "Empty text")
+    key = cache_key(req.tone, req.maxSentences, text)
+    cached = _cache.get(key)
+    final = None
+    if not cached:
+        try:
+            final = await single_flight("f:" + key, lambda: final_input(chunk(text), req.tone, req.maxSentences))
+        except openai.OpenAIError as e:
+            raise upstream_error(e)
+        except Exception as e:
+            raise HTTPException(500, f"Summarization failed: {e}")
+        # Wait for the first delta before committing to a 200, so upstream 429/402/504s
+        # surface as HTTP statuses the client can back off on.
+        deltas = stream_chunk(final, req.tone, req.maxSentences)
+        try:
+            first = await deltas.__anext__()
+        except StopAsyncIteration:
+            first = ""
+        except openai.OpenAIError as e:
+            raise upstream_error(e)
+
+    async def gen():
+        if cached:
+            yield sse({"delta": cached})
+            yield sse({"done": True})
+            return
+        buf: List[str] = [first]
+        try:
+            if first:
+                yield sse({"delta": first})
+            async for delta in deltas:
+                buf.append(delta)
+                yield sse({"delta": delta})
+        except openai.OpenAIError as e:
+            err = upstream_error(e)
+            yield sse({"error": err.detail, "status": err.status_code})
+            return
+        finally:
+            await deltas.aclose()
+        out = "".join(buf).strip()
+        if out:
+            _cache[key] = out
+        yield sse({"done": True})
+
+    return StreamingResponse(gen(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Cache": "HIT" if cached else "MISS"})
+
 def require_admin(r: Request):
     if r.headers.get("x-admin-token") != ADMIN_TOKEN:
         raise HTTPException(401, "Unauthorized")
 
+IP_KEY = IP_SALT.encode()[:64]
+
+@lru_cache(maxsize=10_000)
 def hip(ip: str) -> str:
-    return hashlib.sha256(f"{IP_SALT}:{ip}".encode()).hexdigest()
+    return hashlib.blake2b(ip.encode(), key=IP_KEY, digest_size=16).hexdigest()
 
-@app.post("/ping")
-async def ping(req: Ping, request: Request, pool: AsyncConnectionPool = Depends(get_pool)):
+@app.post("/ping", status_code=202, dependencies=[Depends(get_pool)])
+async def ping(req: Ping, request: Request):
+    global _ping_drop_at
     action = (req.action or "").strip().lower()
     if action in {"summary_success", "successful_summary"}:
         action = "successful_summary"
@@ -147,40 +598,44 @@ async def ping(req: Ping, request: Request, pool: AsyncConnectionPool = Depends(
     ip = request.client.host or "0.0.0.0"
     ua = request.headers.get("user-agent", "")
     ext_ver = req.ext_version
-    async with pool.connection() as conn:
-        await conn.execute(
-            "INSERT INTO pings(user_id,action,ext_version,ua,ip_hash) VALUES (%s,%s,%s,%s,%s)",
-            (req.id, action, ext_ver, ua, hip(ip)),
-        )
+    try:
+        _ping_queue.put_nowait((req.id, action, ext_ver, ua, hip(ip)))
+    except asyncio.QueueFull:
+        now = time.monotonic()
+        if now - _ping_drop_at >= WINDOW_SEC:
+            _ping_drop_at = now
+            log.warning("Ping queue full (%d); dropping pings", _ping_queue.maxsize)
     return {"ok": True}
 
-async def fetchval(conn, sql: str, params: tuple = ()) -> int:
-    async with conn.cursor() as cur:
-        await cur.execute(sql, params)
-        row = await cur.fetchone()
-        return row[0] if row and row[0] is not None else 0
+METRICS_SQL = """
+WITH installs AS (
+  SELECT (SELECT n FROM ping_user_count) AS lifetime, COUNT(*) AS installs24
+  FROM ping_users WHERE first_seen >= NOW() - interval '1 day'
+), recent AS (
+  SELECT
+    COUNT(DISTINCT user_id) FILTER (WHERE action='successful_summary') AS active5,
+    COUNT(*) FILTER (WHERE action='successful_summary' AND ts >= NOW() - interval '1 minute') AS s1,
+    COUNT(*) FILTER (WHERE action='successful_summary') AS s5,
+    COUNT(*) FILTER (WHERE action='error') AS e5
+  FROM pings
+  WHERE ts >= NOW() - interval '5 minutes' AND action IN ('successful_summary', 'error')
+), versions AS (
+  SELECT COALESCE(json_agg(json_build_object('version', v, 'count', n) ORDER BY n DESC), '[]'::json) AS versions
+  FROM (
+    SELECT COALESCE(ext_version,'unknown') AS v, COUNT(*) AS n
+    FROM pings WHERE ts >= NOW() - interval '1 day' GROUP BY 1
+  ) t
+)
+SELECT NOW() AS as_of, * FROM installs, recent, versions
+"""
 
-@app.get("/analytics/now")
-async def analytics_now(request: Request, pool: AsyncConnectionPool = Depends(get_pool)):
-    require_admin(request)
-    now = datetime.utcnow()
-    d1 = now - timedelta(days=1)
-    m1 = now - timedelta(minutes=1)
-    m5 = now - timedelta(minutes=5)
-    async with pool.connection() as conn:
-        lifetime = await fetchval(conn, "SELECT COUNT(*) FROM (SELECT user_id, MIN(ts) FROM pings GROUP BY user_id) t")
-        installs24 = await fetchval(conn, "SELECT COUNT(*) FROM (SELECT user_id, MIN(ts) first_seen FROM pings GROUP BY user_id) t WHERE t.first_seen >= %s", (d1,))
-        active5 = await fetchval(conn, "SELECT COUNT(DISTINCT user_id) FROM pings WHERE action='successful_summary' AND ts >= %s", (m5,))
-        s1 = await fetchval(conn, "SELECT COUNT(*) FROM pings WHERE action='successful_summary' AND ts >= %s", (m1,))
-        s5 = await fetchval(conn, "SELECT COUNT(*) FROM pings WHERE action='successful_summary' AND ts >= %s", (m5,))
-        e5 = await fetchval(conn, "SELECT COUNT(*) FROM pings WHERE action='error' AND ts >= %s", (m5,))
-        versions = []
-        async with conn.cursor() as cur:
-            await cur.execute("SELECT COALESCE(ext_version,'unknown'), COUNT(*) FROM pings WHERE ts >= %s GROUP BY 1 ORDER BY 2 DESC", (d1,))
-            async for r in cur:
-                versions.append({"version": r[0], "count": r[1]})
+async def analytics_snapshot(pool: asyncpg.Pool) -> dict:
+    async with pool.acquire() as conn:
+        m = await conn.fetchrow(METRICS_SQL)
+    lifetime, installs24, active5, s1, s5, e5 = m["lifetime"], m["installs24"], m["active5"], m["s1"], m["s5"], m["e5"]
+    versions = orjson.loads(m["versions"])
     er = (e5 or 0) / max(1, (s5 or 0) + (e5 or 0))
-    return JSONResponse({
+    return {
         "lifetime_installs": int(lifetime or 0),
         "installs_24h": int(installs24 or 0),
         "active_users_5m": int(active5 or 0),
@@ -189,13 +644,80 @@ async def analytics_now(request: Request, pool: AsyncConnectionPool = Depends(ge
         "errors_5m": int(e5 or 0),
         "error_rate_5m": round(er, 4),
         "version_mix_24h": versions,
-        "as_of_utc": now.isoformat() + "Z"
-    })
+        "as_of_utc": m["as_of"],
+    }
+
+ANALYTICS_TTL_SEC = int(os.getenv("ANALYTICS_TTL_SEC", "10"))
+_analytics_cache: tuple[int, dict] | None = None
+_analytics_lock = asyncio.Lock()
+
+def analytics_bucket() -> int:
+    return int(time.time() // ANALYTICS_TTL_SEC)
+
+async def cached_analytics(pool: asyncpg.Pool) -> dict:
+    global _analytics_cache
+    if _analytics_cache and _analytics_cache[0] == analytics_bucket():
+        return _analytics_cache[1]
+    # Only one coroutine refreshes; concurrent pollers wait and reuse its result.
+    async with _analytics_lock:
+        bucket = analytics_bucket()
+        if not _analytics_cache or _analytics_cache[0] != bucket:
+            _analytics_cache = (bucket, await analytics_snapshot(pool))
+        return _analytics_cache[1]
+
+@app.get("/analytics/now")
+async def analytics_now(request: Request, pool: asyncpg.Pool = Depends(get_pool)):
+    require_admin(request)
+    return await cached_analytics(pool)
 
 @app.get("/analytics")
-async def analytics_alias(request: Request, pool: AsyncConnectionPool = Depends(get_pool)):
+async def analytics_alias(request: Request, pool: asyncpg.Pool = Depends(get_pool)):
     return await analytics_now(request, pool)
 
+# Push at most once per analytics bucket; pushes and polls share one refresh.
+PUSH_MIN_INTERVAL_S = max(ANALYTICS_TTL_SEC, 5)
+_dashboards: set[WebSocket] = set()
+_pings_changed = asyncio.Event()
+_push_task: asyncio.Task | None = None
+
+async def analytics_pusher():
+    # One snapshot per burst of flushed pings, shared by every open dashboard.
+    while True:
+        await _pings_changed.wait()
+        _pings_changed.clear()
+        if _dashboards:
+            try:
+                msg = orjson.dumps(await cached_analytics(POOL)).decode()
+            except Exception:
+                log.exception("Analytics push failed")
+            else:
+                for ws in list(_dashboards):
+                    try:
+                        await ws.send_text(msg)
+                    except Exception:
+                        _dashboards.discard(ws)
+        await asyncio.sleep(PUSH_MIN_INTERVAL_S)
+
+@app.websocket("/ws/analytics")
+async def analytics_ws(ws: WebSocket):
+    await ws.accept()
+    # The token arrives as the first message so it never appears in access-logged URLs.
+    try:
+        token = await asyncio.wait_for(ws.receive_text(), 5)
+    except (asyncio.TimeoutError, WebSocketDisconnect):
+        token = None
+    if token != ADMIN_TOKEN or POOL is None:
+        await ws.close(code=1008)
+        return
+    _dashboards.add(ws)
+    try:
+        while True:
+            await ws.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        _dashboards.discard(ws)
+
 DASHBOARD_HTML = """
 <!doctype html><meta charset="utf-8"><title>Summarize Sidekick – Live</title>
 <style>body{font-family:system-ui,-apple-system,Segoe UI,Roboto;margin:24px}.grid{display:grid;grid-template-columns:repeat(3,minmax(220px,1fr));gap:16px}.card{border:1px solid #e5e7eb;border-radius:12px;padding:16px}.k{color:#6b7280;font-size:12px;text-transform:uppercase;letter-spacing:.06em}.v{font-size:28px;font-weight:700;margin-top:6px}.small{font-size:12px;color:#6b7280;margin-top:6px}</style>
@@ -211,22 +733,51 @@ DASHBOARD_HTML = """
 <div class="card" style="margin-top:16px"><div class="k">Version mix (24h)</div><ul id="ver"></ul></div>
 <script>
 const TOKEN=localStorage.getItem("ADMIN_TOKEN")||prompt("Admin token:");if(TOKEN)localStorage.setItem("ADMIN_TOKEN",TOKEN);
+function render(d){
+  const set=(i,v)=>document.getElementById(i).innerText=v;
+  set('lifetime',d.lifetime_installs);set('inst24',d.installs_24h);set('active5',d.active_users_5m);
+  set('spm',d.summaries_per_min);set('s5',d.summaries_5m);set('err',(d.error_rate_5m*100).toFixed(1)+"%");
+  const ul=document.getElementById('ver');ul.innerHTML="";(d.version_mix_24h||[]).forEach(v=>{const li=document.createElement('li');li.textContent=`${v.version}: ${v.count}`;ul.appendChild(li);});
+  document.getElementById('updated').innerText="Updated "+new Date(d.as_of_utc).toLocaleTimeString();
+}
 async function tick(){
   try{
     const r=await fetch("/analytics/now",{headers:{"x-admin-token":TOKEN}});
     if(!r.ok){document.getElementById('updated').innerText="Unauthorized/bad token";return;}
-    const d=await r.json(),set=(i,v)=>document.getElementById(i).innerText=v;
-    set('lifetime',d.lifetime_installs);set('inst24',d.installs_24h);set('active5',d.active_users_5m);
-    set('spm',d.summaries_per_min);set('s5',d.summaries_5m);set('err',(d.error_rate_5m*100).toFixed(1)+"%");
-    const ul=document.getElementById('ver');ul.innerHTML="";(d.version_mix_24h||[]).forEach(v=>{const li=document.createElement('li');li.textContent=`${v.version}: ${v.count}`;ul.appendChild(li);});
-    document.getElementById('updated').innerText="Updated "+new Date(d.as_of_utc).toLocaleTimeString();
+    render(await r.json());
   }catch(e){document.getElementById('updated').innerText="Error: "+e.message;}
 }
-tick();setInterval(tick,5000);
+function connect(){
+  const ws=new WebSocket((location.protocol==="https:"?"wss://":"ws://")+location.host+"/ws/analytics");
+  ws.onopen=()=>ws.send(TOKEN);
+  ws.onmessage=e=>render(JSON.parse(e.data));
+  ws.onclose=()=>setTimeout(()=>{tick();connect();},5000);
+}
+// Pushes arrive when pings land; the slow poll only lets quiet windows age out.
+tick();connect();setInterval(tick,60000);
 </script>
 """
 
+_DASH_BYTES = DASHBOARD_HTML.encode()
+_DASH_GZ = gzip.compress(_DASH_BYTES, 9)
+_DASH_HASH = hashlib.blake2b(_DASH_BYTES, digest_size=16).hexdigest()
+# Each representation gets its own strong validator: the gzip bytes differ from the identity bytes.
+_DASH_HEADERS = {"Cache-Control": "public, max-age=3600", "ETag": f'"{_DASH_HASH}"', "Vary": "Accept-Encoding"}
+_DASH_GZ_HEADERS = {**_DASH_HEADERS, "ETag": f'"{_DASH_HASH}-gz"'}
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison and may list several tags or "*".
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in (t[2:] if t.startswith("W/") else t for t in tags)
+
 @app.get("/dashboard")
-def dashboard():
-    return HTMLResponse(DASHBOARD_HTML)
+def dashboard(request: Request):
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        body, headers = _DASH_GZ, {**_DASH_GZ_HEADERS, "Content-Encoding": "gzip"}
+    else:
+        body, headers = _DASH_BYTES, _DASH_HEADERS
+    inm = request.headers.get("if-none-match")
+    if inm and etag_matches(inm, headers["ETag"]):
+        return Response(status_code=304, headers={k: v for k, v in headers.items() if k != "Content-Encoding"})
+    return Response(body, media_type="text/html", headers=headers)
 
@@ -6,8 +6,10 @@ const API_BASE = "https://summarize-selection.onrender.com"; // Render URL
 const MAX_RETRIES = 3;
 const RETRY_BASE_DELAY_MS = 600;
 
-// ====== HTTP helper with 429 backoff ======
-async function postJSON(path, body) {
+const STREAM_PAINT_MS = 150;
+
+// ====== HTTP helpers with 429 backoff ======
+async function postWithRetry(path, body) {
   let attempt = 0;
   let delay = RETRY_BASE_DELAY_MS;
 
@@ -18,14 +20,7 @@ async function postJSON(path, body) {
       body: JSON.stringify(body),
     });
 
-    if (res.ok) {
-      const txt = await res.text();
-      try {
-        return JSON.parse(txt);
-      } catch {
-        throw new Error(`Invalid JSON from backend: ${txt}`);
-      }
-    }
+    if (res.ok) return res;
 
     if (res.status === 429 && attempt < MAX_RETRIES) {
       await new Promise((r) => setTimeout(r, delay));
@@ -39,11 +34,50 @@ async function postJSON(path, body) {
   }
 }
 
+async function postJSON(path, body) {
+  const res = await postWithRetry(path, body);
+  const txt = await res.text();
+  try {
+    return JSON.parse(txt);
+  } catch {
+    throw new Error(`Invalid JSON from backend: ${txt}`);
+  }
+}
+
 async function summarize(text, tone = "precise", maxSentences = 3) {
   if (!text || !text.trim()) throw new Error("No text provided to summarize.");
   return postJSON("/summarize", { text, tone, maxSentences });
 }
 
+// Reads the SSE stream from /summarize/stream; onDelta gets the text so far.
+async function summarizeStream(text, tone, maxSentences, onDelta) {
+  if (!text || !text.trim()) throw new Error("No text provided to summarize.");
+  const res = await postWithRetry("/summarize/stream", { text, tone, maxSentences });
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "";
+  let out = "";
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buf += decoder.decode(value, { stream: true });
+    let i;
+    while ((i = buf.indexOf("\n\n")) !== -1) {
+      const line = buf.slice(0, i);
+      buf = buf.slice(i + 2);
+      if (!line.startsWith("data: ")) continue;
+      const ev = JSON.parse(line.slice(6));
+      if (ev.error) throw new Error(`HTTP ${ev.status}: ${ev.error}`);
+      if (ev.delta) {
+        out += ev.delta;
+        await onDelta(out);
+      }
+    }
+  }
+  return out.trim();
+}
+
 // ====== Injected UI helpers ======
 // One bubble per page that we can update in-place (shows loading then result)
 function upsertSummaryBubble(text, opts = {}) {
@@ -164,8 +198,15 @@ async function handleSummarizeInTab(tabId, selectedText) {
     const prefs = await chrome.storage.sync.get(["tone", "maxSentences"]);
     const tone = prefs.tone || "precise";
     const maxSentences = Math.max(1, Math.min(10, parseInt(prefs.maxSentences || "3", 10)));
-    const result = await summarize(selectedText, tone, maxSentences);
-    await showBubble(tabId, result.summary || "(no summary returned)");
+    // Stream tokens into the bubble, repainting at most every STREAM_PAINT_MS.
+    let lastPaint = 0;
+    const summary = await summarizeStream(selectedText, tone, maxSentences, async (soFar) => {
+      const now = Date.now();
+      if (now - lastPaint < STREAM_PAINT_MS) return;
+      lastPaint = now;
+      await showBubble(tabId, soFar, true);
+    });
+    await showBubble(tabId, summary || "(no summary returned)");
   } catch (err) {
     await showBubble(tabId, `Error: ${String(err)}`);
   }